@@ -1,118 +1,240 @@
-import json
+import atexit
+import collections
+import copy
+import functools
+import hashlib
+import importlib
 import os
 import time
 import threading
 import datetime
 import io
 import contextlib
-import sys
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for, make_response
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.calendarinterval import CalendarIntervalTrigger
+from apscheduler.triggers.combining import OrTrigger
+from apscheduler.triggers.cron import CronTrigger
 
-# Import your controllers
-from controllers import dota_controller, weather_controller, strava_controller, energy_controller, f1_controller, family_controller
+from controllers import _fastjson as fastjson
+
+# Register your controllers: job name -> module. Each is imported the first time
+# its job runs rather than at startup, so the dashboard is up before any of them
+# (and requests, urllib3, jwt behind them) have loaded.
+CONTROLLERS = {
+    'dota': 'controllers.dota_controller',
+    'weather': 'controllers.weather_controller',
+    'fitness': 'controllers.strava_controller',
+    'energy': 'controllers.energy_controller',
+    'f1': 'controllers.f1_controller',
+    'family': 'controllers.family_controller',
+}
+
+@functools.lru_cache(maxsize=None)
+def get_controller(name):
+    return importlib.import_module(CONTROLLERS[name])
 
 app = Flask(__name__)
 CONFIG_FILE = 'config.json'
-LOG_FILE = 'logs.json'
+LOG_FILE = 'logs.jsonl'
+LEGACY_LOG_FILE = 'logs.json'
+LOG_KEEP = 10                   # Runs shown per job on the dashboard
+LOG_FLUSH_DELAY = 1.0           # Seconds log_run waits to batch its append
+LOG_LOCK = threading.Lock()
+LOG_RING = {}                   # job -> deque of its last LOG_KEEP runs, newest first
+_LOG_PENDING = []               # Encoded lines not yet appended to LOG_FILE
+_LOG_FLUSH_TIMER = None
+LOG_GENERATION = 0              # Bumped on every log_run, part of the dashboard ETag
+BOOT_ID = str(time.time())
+JOB_NAMES = tuple(CONTROLLERS)
 
 # --- CONFIG & LOGGING ---
+CONFIG_DEFAULTS = {
+    "dota":    {"enabled": False, "mode": "interval", "interval": 15, "times": ["08:00"], "days": 1},
+    "weather": {"enabled": False, "mode": "interval", "interval": 30, "times": ["10:00", "14:00"], "days": 1},
+    "fitness": {"enabled": False, "mode": "interval", "interval": 60, "times": ["22:00"], "days": 1},
+    "energy":  {"enabled": False, "mode": "interval", "interval": 60, "times": ["08:00"], "days": 3},
+    "f1":      {"enabled": False, "mode": "interval", "interval": 1440, "times": ["12:00"], "days": 1},
+    "family":  {"enabled": False, "mode": "schedule", "interval": 60, "times": ["05:00", "12:00", "18:00"], "days": 1},
+    "system":  {"gateway_ip": "192.168.220.206", "store_code": "", "gateway_gzip": False}
+}
+
+# Parsed config.json, keyed on the file's mtime and size. Strava rewrites the
+# file from its own controller, so the stat is what notices that, not save_config.
+_CFG_CACHE = {"stamp": None, "data": None}
+
+def _config_stamp():
+    st = os.stat(CONFIG_FILE)
+    return (st.st_mtime_ns, st.st_size)
+
 def load_config():
-    defaults = {
-        "dota":    {"enabled": False, "mode": "interval", "interval": 15, "times": ["08:00"], "days": 1},
-        "weather": {"enabled": False, "mode": "interval", "interval": 30, "times": ["10:00", "14:00"], "days": 1},
-        "fitness": {"enabled": False, "mode": "interval", "interval": 60, "times": ["22:00"], "days": 1},
-        "energy":  {"enabled": False, "mode": "interval", "interval": 60, "times": ["08:00"], "days": 3},
-        "f1":      {"enabled": False, "mode": "interval", "interval": 1440, "times": ["12:00"], "days": 1},
-        "family":  {"enabled": False, "mode": "schedule", "interval": 60, "times": ["05:00", "12:00", "18:00"], "days": 1},
-        "system":  {"gateway_ip": "192.168.220.206", "store_code": ""}
-    }
-    
-    if not os.path.exists(CONFIG_FILE): return defaults
-    
-    with open(CONFIG_FILE, 'r') as f: 
-        data = json.load(f)
-    
-    for key, val in defaults.items():
-        if key not in data: data[key] = val
-        else:
-            for k, v in val.items():
-                if k not in data[key]: data[key][k] = v
-    return data
+    try:
+        stamp = _config_stamp()
+    except FileNotFoundError:
+        return copy.deepcopy(CONFIG_DEFAULTS)
+
+    if stamp != _CFG_CACHE["stamp"]:
+        with open(CONFIG_FILE, 'rb') as f: 
+            data = fastjson.loads(f.read())
+        
+        for key, val in CONFIG_DEFAULTS.items():
+            if key not in data: data[key] = copy.deepcopy(val)
+            else:
+                for k, v in val.items():
+                    if k not in data[key]: data[key][k] = copy.deepcopy(v)
+        _CFG_CACHE.update(stamp=stamp, data=data)
+
+    # Callers mutate what they get back (update_settings edits it in place)
+    return copy.deepcopy(_CFG_CACHE["data"])
 
 def save_config(data):
-    with open(CONFIG_FILE, 'w') as f: json.dump(data, f, indent=2)
+    # Serialise first: a streaming dump issues a write per token, this is one write
+    payload = fastjson.dumps(data, indent=True)
+    with open(CONFIG_FILE, 'wb') as f: f.write(payload)
+    _CFG_CACHE.update(stamp=_config_stamp(), data=copy.deepcopy(data))
 
-def load_logs():
-    if not os.path.exists(LOG_FILE): 
-        return {"dota": [], "weather": [], "fitness": [], "energy": [], "f1": [], "family": []}
+def _empty_logs():
+    return {name: [] for name in JOB_NAMES}
+
+def _migrate_legacy_logs():
+    # logs.json held every job's last runs in one document that was rewritten in
+    # full on every run. Carry those entries over once, oldest first, so the
+    # dashboard does not come up empty after the switch to logs.jsonl.
+    if os.path.exists(LOG_FILE) or not os.path.exists(LEGACY_LOG_FILE): return
     try:
-        with open(LOG_FILE, 'r') as f: 
-            logs = json.load(f)
+        with open(LEGACY_LOG_FILE, 'rb') as f:
+            legacy = fastjson.loads(f.read())
+    except Exception:
+        return
+    lines = []
+    for job_name, entries in legacy.items():
+        for entry in reversed(entries):
             # Migration: If old logs are strings, convert them to dicts
-            for k in logs:
-                for i, entry in enumerate(logs[k]):
-                    if isinstance(entry, str):
-                        logs[k][i] = {"time": entry, "status": "Legacy", "output": "No details available."}
-            return logs
-    except:
-        return {"dota": [], "weather": [], "fitness": [], "energy": [], "f1": [], "family": []}
+            if isinstance(entry, str):
+                entry = {"time": entry, "status": "Legacy", "output": "No details available."}
+            lines.append(fastjson.dumps({"job": job_name, **entry}) + b"\n")
+    with open(LOG_FILE, 'wb') as f: f.write(b"".join(lines))
 
-def log_run(job_name, status, output):
+def load_logs():
+    logs = _empty_logs()
+    if not os.path.exists(LOG_FILE): return logs
+
+    with open(LOG_FILE, 'rb') as f:
+        lines = f.read().splitlines()
+
+    # Newest entries are at the end of the file, the dashboard wants them first
+    for line in reversed(lines):
+        try:
+            entry = fastjson.loads(line)
+        except ValueError:
+            continue
+        bucket = logs.setdefault(entry.pop("job", "unknown"), [])
+        if len(bucket) < LOG_KEEP: bucket.append(entry)
+    return logs
+
+def init_log_ring():
+    # The one full read of the log file. After this the dashboard is served from
+    # LOG_RING and the file is only ever appended to or rewritten from it.
     logs = load_logs()
-    if job_name not in logs: logs[job_name] = []
-    
-    timestamp = datetime.datetime.now().strftime("%I:%M %p, %b %d")
+    with LOG_LOCK:
+        for job_name, entries in logs.items():
+            LOG_RING[job_name] = collections.deque(entries, maxlen=LOG_KEEP)
+
+def dashboard_etag():
+    try:
+        config_version = _config_stamp()
+    except FileNotFoundError:
+        config_version = None
+    # BOOT_ID because LOG_GENERATION restarts from zero with the process
+    key = f"{BOOT_ID}|{config_version}|{LOG_GENERATION}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+def snapshot_logs():
+    with LOG_LOCK:
+        logs = {job_name: list(ring) for job_name, ring in LOG_RING.items()}
+    for job_name in JOB_NAMES: logs.setdefault(job_name, [])
+    return logs
+
+def _flush_logs():
+    global _LOG_FLUSH_TIMER
+    with LOG_LOCK:
+        _LOG_FLUSH_TIMER = None
+        if not _LOG_PENDING: return
+        lines = b"".join(_LOG_PENDING)
+        _LOG_PENDING.clear()
+        with open(LOG_FILE, 'ab') as f: f.write(lines)
+
+# Log times only go to the minute, so every run within one formats once
+@functools.lru_cache(maxsize=64)
+def _minute_stamp(minute_epoch, fmt="%I:%M %p, %b %d"):
+    return datetime.datetime.fromtimestamp(minute_epoch * 60).strftime(fmt)
+
+def log_run(job_name, status, output):
+    global _LOG_FLUSH_TIMER, LOG_GENERATION
+    timestamp = _minute_stamp(int(time.time()) // 60)
     
     entry = {
         "time": timestamp,
         "status": status,
         "output": output
     }
+    line = fastjson.dumps({"job": job_name, **entry}) + b"\n"
     
-    logs[job_name].insert(0, entry)
-    logs[job_name] = logs[job_name][:10] # Keep last 10 runs
-    
-    with open(LOG_FILE, 'w') as f: json.dump(logs, f, indent=2)
+    # Append only, and debounced: runs finishing close together (a burst of
+    # manual triggers) share a single write. trim_logs() bounds the file.
+    with LOG_LOCK:
+        LOG_RING.setdefault(job_name, collections.deque(maxlen=LOG_KEEP)).appendleft(entry)
+        LOG_GENERATION += 1
+        _LOG_PENDING.append(line)
+        if _LOG_FLUSH_TIMER: _LOG_FLUSH_TIMER.cancel()
+        _LOG_FLUSH_TIMER = threading.Timer(LOG_FLUSH_DELAY, _flush_logs)
+        _LOG_FLUSH_TIMER.daemon = True
+        _LOG_FLUSH_TIMER.start()
+
+def trim_logs():
+    # Rewrite the file from LOG_RING, which already holds exactly the last
+    # LOG_KEEP runs per job, pending lines included. Held under the lock so a
+    # run finishing mid-trim is not lost by the replace.
+    global _LOG_FLUSH_TIMER
+    with LOG_LOCK:
+        lines = [fastjson.dumps({"job": job_name, **entry}) + b"\n"
+                 for job_name, ring in LOG_RING.items() for entry in reversed(ring)]
+        tmp = LOG_FILE + '.tmp'
+        with open(tmp, 'wb') as f: f.write(b"".join(lines))
+        os.replace(tmp, LOG_FILE)
+        _LOG_PENDING.clear()
+        if _LOG_FLUSH_TIMER: _LOG_FLUSH_TIMER.cancel()
+        _LOG_FLUSH_TIMER = None
 
 # --- JOB WRAPPERS ---
-def run_job(name, func, force=False):
+# Each run gets its own log: lines go to the terminal and to this run's
+# buffer. Swapping sys.stdout instead is process wide, so a manual
+# trigger overlapping a scheduled job would capture each other's output.
+def _run_logger():
+    capture_buffer = io.StringIO()
+
+    def log(*args):
+        line = " ".join(map(str, args))
+        print(line)
+        capture_buffer.write(line + "\n")
+
+    return log, capture_buffer
+
+def run_job(name, force=False):
     cfg = load_config()
     
     if force or cfg.get(name, {}).get('enabled'):
         trigger_type = "Manual" if force else "Scheduled"
-        
-        # Capture Stdout/Stderr
-        capture_buffer = io.StringIO()
+        log, capture_buffer = _run_logger()
         status = "Success"
-        
-        # Redirect prints to buffer AND original terminal
-        class Tee(object):
-            def __init__(self, *files): self.files = files
-            def write(self, obj):
-                for f in self.files: f.write(obj)
-            def flush(self):
-                for f in self.files: f.flush()
-
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        
+
+        log(f"⏰ {trigger_type} Job: {name.capitalize()}")
         try:
-            # Send output to both capture buffer and real terminal
-            sys.stdout = Tee(sys.stdout, capture_buffer)
-            sys.stderr = Tee(sys.stderr, capture_buffer)
-            
-            print(f"⏰ {trigger_type} Job: {name.capitalize()}")
-            try:
-                func.run(cfg)
-            except Exception as e:
-                status = "Failed"
-                print(f"❌ {name.capitalize()} Job Failed: {e}")
-                
-        finally:
-            # Restore stdout/stderr
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
+            get_controller(name).run(cfg, log=log)
+        except Exception as e:
+            status = "Failed"
+            log(f"❌ {name.capitalize()} Job Failed: {e}")
             
         log_run(name, status, capture_buffer.getvalue())
         
@@ -120,65 +242,182 @@ def run_job(name, func, force=False):
         # Scheduled run but disabled
         pass
 
-# --- SCHEDULING LOGIC ---
-def reschedule_all():
+# Jobs whose run() takes gateway= and queues its tag on it instead of pushing
+BATCH_JOBS = ('weather', 'fitness')
+
+def run_batch(names=BATCH_JOBS):
+    # Scheduled in place of the BATCH_JOBS' own jobs when they share a schedule.
+    # Runs the enabled ones against one GatewayClient, then sends all of their
+    # tags in a single POST. Each job still gets its own log entry.
+    from controllers._gateway import GatewayClient     # Lazy, like the controllers
     cfg = load_config()
-    scheduler.remove_all_jobs()
-    
-    job_map = {
-        'dota': dota_controller,
-        'weather': weather_controller,
-        'fitness': strava_controller,
-        'energy': energy_controller,
-        'f1': f1_controller,
-        'family': family_controller
-    }
+    gateway = GatewayClient.from_config(cfg)
+    runs = []
+
+    for name in names:
+        if not cfg.get(name, {}).get('enabled'): continue
+        log, capture_buffer = _run_logger()
+        status = "Success"
+        log(f"⏰ Scheduled Batch Job: {name.capitalize()}")
+        queued = len(gateway.pending)
+        try:
+            get_controller(name).run(cfg, log=log, gateway=gateway)
+        except Exception as e:
+            status = "Failed"
+            log(f"❌ {name.capitalize()} Job Failed: {e}")
+        runs.append((name, status, log, capture_buffer, len(gateway.pending) > queued))
+
+    count = len(gateway.pending)
+    try:
+        r = gateway.flush()
+        error = None if r is None or r.status_code == 200 else f"Gateway Error {r.status_code}: {r.text[:300]}"
+    except Exception as e:
+        error = f"Connection Error (Gateway): {e}"
+
+    for name, status, log, capture_buffer, was_queued in runs:
+        if was_queued:
+            if error:
+                status = "Failed"
+                log(f"❌ {error}")
+            else:
+                log(f"🚀 Batch push sent {count} tag(s) in one request")
+        log_run(name, status, capture_buffer.getvalue())
+
+# --- SCHEDULING LOGIC ---
+# What each job is currently scheduled as: name -> (signature, [job ids]).
+# reschedule_all() diffs against this, so a settings save only touches the
+# jobs whose schedule actually changed and the rest keep their next run.
+# "batch" stands in for BATCH_JOBS while they share one schedule.
+_SCHEDULED = {}
+_RESCHEDULE_LOCK = threading.Lock()
+
+def _schedule_signature(settings):
+    if settings.get('mode') == 'interval':
+        return ('interval', int(settings.get('interval', 30)))
+    return ('schedule', int(settings.get('days', 1)), tuple(settings.get('times', [])))
+
+def _schedule_plan(cfg):
+    # What reschedule_all() should have running: name -> signature. When the
+    # BATCH_JOBS are on the same schedule they become one run_batch job, so each
+    # fire sends their tags in one POST instead of one POST per job.
+    plan = {name: _schedule_signature(cfg.get(name, {})) for name in CONTROLLERS}
+    shared = {plan[name] for name in BATCH_JOBS}
+    if len(shared) == 1:
+        for name in BATCH_JOBS: del plan[name]
+        plan['batch'] = shared.pop()
+    return plan
 
-    print("🔄 Rescheduling Jobs...")
+def _add_jobs(name, signature):
+    job_ids = []
+    func, args = (run_batch, []) if name == 'batch' else (run_job, [name, False])
 
-    for name, controller in job_map.items():
-        settings = cfg.get(name, {})
+    # MODE 1: INTERVAL
+    if signature[0] == 'interval':
+        minutes = signature[1]
+        scheduler.add_job(
+            func, 'interval', minutes=minutes, 
+            args=args, id=f"{name}_interval"
+        )
+        job_ids.append(f"{name}_interval")
+        print(f"   -> {name}: Every {minutes} mins")
+
+    # MODE 2: SPECIFIC TIMES
+    # One job per controller, firing on any of its wall clock times. Cron keeps
+    # to the clock across DST where a fixed days=N interval drifts by an hour.
+    # One cron per time, not hour=",".join(...), which would cross every hour
+    # with every minute. day="*/N" counts from the 1st of each month; cron's day
+    # field stops at 31, so longer gaps count calendar days from today instead.
+    else:
+        _, days_gap, times = signature
+        triggers, valid_times = [], []
+        if days_gap < 1:
+            print(f"   ⚠️ {name}: days must be 1 or more in schedule mode, got {days_gap}")
+            return job_ids
         
-        # MODE 1: INTERVAL
-        if settings.get('mode') == 'interval':
-            minutes = int(settings.get('interval', 30))
+        for t_str in times:
+            try:
+                h, m = map(int, t_str.split(':'))
+                if not (0 <= h < 24 and 0 <= m < 60): raise ValueError
+            except ValueError:
+                print(f"   ⚠️ Invalid time format for {name}: {t_str}")
+                continue
+            if days_gap <= 30:
+                triggers.append(CronTrigger(day=f"*/{days_gap}", hour=h, minute=m))
+            else:
+                triggers.append(CalendarIntervalTrigger(days=days_gap, hour=h, minute=m))
+            valid_times.append(t_str)
+
+        if triggers:
+            trigger = triggers[0] if len(triggers) == 1 else OrTrigger(triggers)
             scheduler.add_job(
-                run_job, 'interval', minutes=minutes, 
-                args=[name, controller, False], id=f"{name}_interval"
+                func, trigger,
+                args=args, id=f"{name}_schedule"
             )
-            print(f"   -> {name}: Every {minutes} mins")
+            job_ids.append(f"{name}_schedule")
+            print(f"   -> {name}: Every {days_gap} day(s) at {', '.join(valid_times)}")
 
-        # MODE 2: SPECIFIC TIMES
-        else:
-            days_gap = int(settings.get('days', 1))
-            times = settings.get('times', [])
-            
-            for t_str in times:
-                try:
-                    h, m = map(int, t_str.split(':'))
-                    now = datetime.datetime.now()
-                    target = now.replace(hour=h, minute=m, second=0, microsecond=0)
-                    if target <= now:
-                        target += datetime.timedelta(days=1)
-                    
-                    scheduler.add_job(
-                        run_job, 'interval', days=days_gap, start_date=target,
-                        args=[name, controller, False], id=f"{name}_{t_str}"
-                    )
-                    print(f"   -> {name}: Every {days_gap} day(s) at {t_str}")
-
-                except Exception as e:
-                    print(f"   ⚠️ Invalid time format for {name}: {t_str}")
+    return job_ids
+
+def reschedule_all():
+    cfg = load_config()
+
+    with _RESCHEDULE_LOCK:
+        print("🔄 Rescheduling Jobs...")
+        plan = _schedule_plan(cfg)
+
+        # Whatever the plan no longer has, e.g. weather and fitness folding into batch
+        for name in [n for n in _SCHEDULED if n not in plan]:
+            for job_id in _SCHEDULED.pop(name)[1]:
+                scheduler.remove_job(job_id)
+
+        for name, signature in plan.items():
+            current = _SCHEDULED.get(name)
+            if current and current[0] == signature: continue
+
+            # Only the interval length moved: retime the existing job in place
+            if current and current[0][0] == signature[0] == 'interval':
+                scheduler.reschedule_job(f"{name}_interval", trigger='interval', minutes=signature[1])
+                _SCHEDULED[name] = (signature, current[1])
+                print(f"   -> {name}: Every {signature[1]} mins")
+                continue
+
+            for job_id in (current[1] if current else []):
+                scheduler.remove_job(job_id)
+            _SCHEDULED[name] = (signature, _add_jobs(name, signature))
 
 # --- INIT SCHEDULER ---
-scheduler = BackgroundScheduler()
+_migrate_legacy_logs()
+init_log_ring()
+trim_logs()
+atexit.register(_flush_logs)
+# One worker per job type plus one for housekeeping. max_instances=1 means a
+# run that is still going skips its next fire rather than stacking up on
+# another thread; coalesce folds a backlog of missed fires into one run.
+scheduler = BackgroundScheduler(
+    executors={'default': ThreadPoolExecutor(len(JOB_NAMES) + 1)},
+    job_defaults={'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 300}
+)
 scheduler.start()
-threading.Timer(2.0, reschedule_all).start()
+# Hourly keeps the append-only log down to roughly LOG_KEEP runs per job, so
+# the file stays small and the one full read at startup stays quick
+scheduler.add_job(trim_logs, 'interval', hours=1, id="trim_logs")
+# No trigger means run once, now, on the scheduler's own executor
+scheduler.add_job(reschedule_all, id="reschedule_all")
 
 # --- WEB ROUTES ---
 @app.route('/')
 def index():
-    return render_template('index.html', config=load_config(), logs=load_logs())
+    # The page is a function of config.json and LOG_RING alone, so their versions
+    # make a validator. A refresh with nothing new gets a 304 and skips both the
+    # config load and the template render.
+    etag = dashboard_etag()
+    if request.if_none_match.contains_weak(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(render_template('index.html', config=load_config(), logs=snapshot_logs()))
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @app.route('/update', methods=['POST'])
 def update_settings():
@@ -220,7 +459,13 @@ def update_settings():
     if 'fit_client_id' in form:
         config['fitness']['client_id'] = form.get('fit_client_id')
         config['fitness']['client_secret'] = form.get('fit_client_secret')
-        config['fitness']['refresh_token'] = form.get('fit_refresh_token')
+        new_refresh = form.get('fit_refresh_token')
+        # A cached access token belongs to the old refresh token; drop it so
+        # the next run authenticates with the new credentials
+        if new_refresh != config['fitness'].get('refresh_token'):
+            config['fitness'].pop('access_token', None)
+            config['fitness'].pop('expires_at', None)
+        config['fitness']['refresh_token'] = new_refresh
 
     if 'energy_auth_key' in form:
         config['energy']['auth_key'] = form.get('energy_auth_key')
@@ -233,12 +478,8 @@ def update_settings():
 
 @app.route('/trigger/<job_name>')
 def trigger_job(job_name):
-    jobs = {'dota': dota_controller, 'weather': weather_controller, 
-            'fitness': strava_controller, 'energy': energy_controller, 'f1': f1_controller,
-            'family': family_controller}
-    
-    if job_name in jobs:
-        threading.Thread(target=run_job, args=(job_name, jobs[job_name], True)).start()
+    if job_name in CONTROLLERS:
+        threading.Thread(target=run_job, args=(job_name, True)).start()
         
     return redirect(url_for('index'))
 
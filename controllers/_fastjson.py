@@ -0,0 +1,37 @@
+"""
+PROJECT: ESL Hub
+MODULE: JSON helpers
+AUTHOR: Raunak Oberoi
+DATE: Oct 2026
+
+DESCRIPTION:
+One place to encode and decode JSON for the app and the controllers.
+
+Uses orjson when it is installed and the standard library otherwise, so a Pi
+without the wheel still runs. Either way dumps() returns UTF-8 bytes, ready to
+write to a file opened in binary mode or to send as a request body.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:                                   # pragma: no cover
+    orjson = None
+
+
+def dumps(obj, indent=False):
+    """Serialise to bytes. indent=True matches json.dump(..., indent=2)."""
+    if orjson:
+        # NON_STR_KEYS keeps parity with the stdlib, which turns int keys into
+        # strings where orjson would otherwise refuse them.
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def loads(data):
+    """Parse str or bytes. Errors are ValueError with either backend."""
+    return orjson.loads(data) if orjson else json.loads(data)
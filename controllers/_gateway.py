@@ -0,0 +1,136 @@
+"""
+PROJECT: ESL Hub
+MODULE: Gateway Client
+AUTHOR: Raunak Oberoi
+DATE: Oct 2026
+
+DESCRIPTION:
+Talks to the Rainus gateway's /api/product endpoint for the scheduled
+controllers.
+
+Every controller ends a run the same way: wrap its prInfo list in a
+storeCode/taskId/product envelope and POST it to the gateway on the LAN.
+GatewayClient does that for Dota, Energy, F1, Strava and Weather, so their
+encoding, headers, optional gzip, timeouts and retries are decided here once.
+
+Family and Mercedes still build the envelope themselves and post it through
+their own requests session, because both also run as standalone scripts
+outside the app. Nothing here, system.gateway_gzip included, applies to them.
+
+It speaks HTTP/1.1 through the standard library's http.client rather than
+requests. The gateway is plain HTTP on the LAN with no auth, redirects or
+cookies, so the requests/urllib3 stack adds per-call overhead and nothing
+else. Idle keep-alive connections are pooled per gateway at module level and
+shared by every client, so back to back runs reuse them.
+"""
+
+import collections
+import gzip
+import http.client
+import threading
+import time
+
+from controllers import _fastjson as fastjson
+
+HEADERS = {"Content-Type": "application/json", "Connection": "keep-alive"}
+# With system.gateway_gzip on, the body goes compressed. Level 1 is nearly free
+# and prInfo's long runs of "" compress well.
+GZIP_HEADERS = {**HEADERS, "Content-Encoding": "gzip"}
+TIMEOUT = (5, 20)   # (connect, read) seconds
+PATH = "/api/product"
+
+# What push() and flush() return: the two fields the controllers read off a
+# requests.Response, so they did not change when this stopped using requests.
+GatewayResponse = collections.namedtuple("GatewayResponse", "status_code text")
+
+# --- NETWORK HELPER: PERSISTENT CONNECTION ---
+# host -> idle HTTPConnections. A push checks one out and puts it back when
+# done, so jobs pushing at the same time each get their own connection. The
+# lock only guards the lists; it is never held across network I/O.
+_CONNS = collections.defaultdict(list)
+_CONN_LOCK = threading.Lock()
+
+# What a reused connection raises when the gateway has already closed it. A
+# timeout or a refused connect is the gateway itself failing, not the socket
+# going stale, so those are never retried.
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                 ConnectionResetError, BrokenPipeError)
+
+def _connect(host):
+    conn = http.client.HTTPConnection(host, timeout=TIMEOUT[0])
+    conn.connect()
+    conn.sock.settimeout(TIMEOUT[1])
+    return conn
+
+def _send(host, body, headers):
+    with _CONN_LOCK:
+        idle = _CONNS[host]
+        conn = idle.pop() if idle else None
+    if conn is not None:
+        # The gateway drops idle keep-alive connections, which only shows up
+        # when the next request on one fails. Then a fresh one gets a go.
+        try:
+            return _exchange(host, conn, body, headers)
+        except _STALE_ERRORS:
+            pass
+    return _exchange(host, _connect(host), body, headers)
+
+def _exchange(host, conn, body, headers):
+    try:
+        conn.request("POST", PATH, body, headers)
+        resp = conn.getresponse()
+        text = resp.read().decode("utf-8", "replace")
+    except BaseException:
+        conn.close()
+        raise
+    # Only a connection that finished cleanly goes back for the next push
+    if resp.will_close: conn.close()
+    else:
+        with _CONN_LOCK: _CONNS[host].append(conn)
+    return GatewayResponse(resp.status, text)
+
+def _product(tag_id, layout_id, pr_info):
+    return {"prCode": tag_id, "layoutId": layout_id, "prInfo": pr_info, "nfc": ""}
+
+
+class GatewayClient:
+    def __init__(self, gateway_ip, store_code, gzip_body=False):
+        self.host = gateway_ip          # "ip" or "ip:port"
+        self.store_code = store_code
+        self.gzip_body = gzip_body
+        self.pending = []       # Products buffer() has queued for the next flush()
+
+    @classmethod
+    def from_config(cls, full_config):
+        """Client for the gateway in config.json's system block."""
+        sys_cfg = full_config['system']
+        return cls(sys_cfg['gateway_ip'], sys_cfg['store_code'], sys_cfg.get('gateway_gzip', False))
+
+    def push(self, tag_id, layout_id, pr_info, now_ts=None):
+        """Update one tag. Returns the response, whatever its status, and lets
+        connection errors raise so each controller reports them its own way.
+        now_ts is the run's clock reading for the task ID; omitted, it is now."""
+        return self._post([_product(tag_id, layout_id, pr_info)], now_ts)
+
+    def buffer(self, tag_id, layout_id, pr_info):
+        """Queue a tag update for flush() instead of sending it now."""
+        self.pending.append(_product(tag_id, layout_id, pr_info))
+
+    def flush(self):
+        """Send every queued update in one POST, since product is a list. Returns
+        the response, or None when nothing was queued."""
+        if not self.pending: return None
+        products, self.pending = self.pending, []
+        return self._post(products)
+
+    def _post(self, products, now_ts=None):
+        if now_ts is None: now_ts = time.time()
+        payload = {
+            "storeCode": self.store_code,
+            "taskId": str(int(now_ts * 1000)),
+            "product": products
+        }
+        body, headers = fastjson.dumps(payload), HEADERS
+        if self.gzip_body:
+            body, headers = gzip.compress(body, compresslevel=1), GZIP_HEADERS
+        return _send(self.host, body, headers)
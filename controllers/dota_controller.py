@@ -12,17 +12,57 @@ KEY FEATURES:
 - Calculates MMR gain/loss relative to a 'Baseline Match ID'.
 - [UPDATED] Zoomed Sensitivity: Split bars now max out at +/- 20% deviation.
   This makes small win rate changes (e.g., 52%) much more visible.
+- Hero names are cached on disk for a day, since they only change with a patch.
 """
 
 import requests
 import datetime
+import os
 import time
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-def run(full_config):
+from controllers import _fastjson as fastjson
+from controllers._gateway import GatewayClient
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+HERO_CACHE_FILE = os.path.join(DATA_DIR, "heroes_cache.json")
+HERO_CACHE_TTL = 24 * 60 * 60   # Seconds. The hero list only changes with a patch.
+
+# ---- PR map, matching 4p20c_Dota ------------------------------------------
+# The layout only binds slots 200 and up; everything below goes out blank.
+PR_SIZE = 250
+PR_RANK, PR_MMR, PR_WINS_NEEDED = 200, 201, 202
+PR_STATS_20, PR_STATS_7, PR_STATS_30 = (203, 204), (205, 206), (207, 208)   # W-L, pct
+PR_LAST_MATCH, PR_MAIN_BAR = 209, 210
+PR_SPLIT_20, PR_SPLIT_7, PR_SPLIT_30 = (220, 221), (222, 223), (224, 225)   # red, black
+PR_UPDATED = 226
+
+# --- NETWORK HELPER: RETRY SESSION ---
+# Module level, so the hero list and match history calls of every run share
+# one warm connection to OpenDota.
+def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=["HEAD", "GET", "OPTIONS"]
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+TIMEOUT = (5, 20)   # (connect, read) seconds for the OpenDota calls
+
+def run(full_config, log=print):
     # 1. READ CONFIG
-    sys = full_config['system']
     cfg = full_config['dota']
     
     STEAM_ID = cfg['steam_id']
@@ -39,47 +79,52 @@ def run(full_config):
     # (i.e., Winrate > 70% is Full Black, Winrate < 30% is Full Red)
     SENSITIVITY = 20.0 
     
-    GATEWAY_IP = sys['gateway_ip']
-    STORE_CODE = sys['store_code']
+    gateway = GatewayClient.from_config(full_config)
     TAG_ID = cfg['tag_id']
     LAYOUT_ID = "4p20c_Dota"
 
-    # --- NETWORK HELPER: RETRY SESSION ---
-    def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
     # 2. HELPER FUNCTIONS
+    def load_hero_cache():
+        try:
+            with open(HERO_CACHE_FILE, "rb") as f:
+                cache = fastjson.loads(f.read())
+            # JSON object keys are always strings; hero ids are ints
+            return cache['cached_at'], {int(k): v for k, v in cache['heroes'].items()}
+        except Exception:
+            return 0, {}
+
+    def save_hero_cache(heroes):
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            payload = fastjson.dumps({"cached_at": time.time(), "heroes": heroes})
+            with open(HERO_CACHE_FILE, "wb") as f: f.write(payload)
+        except OSError as e:
+            log(f"⚠️ Hero Cache Warning: {e}")
+
     def get_hero_dict():
+        cached_at, cached = load_hero_cache()
+        if cached and time.time() - cached_at < HERO_CACHE_TTL:
+            return cached
         try:
-            r = get_retry_session().get("https://api.opendota.com/api/heroes", timeout=20)
+            r = _SESSION.get("https://api.opendota.com/api/heroes", timeout=TIMEOUT)
             if r.status_code == 200:
-                return {h['id']: h['localized_name'] for h in r.json()}
+                heroes = {h['id']: h['localized_name'] for h in fastjson.loads(r.content)}
+                save_hero_cache(heroes)
+                return heroes
         except Exception as e:
-            print(f"⚠️ Hero Fetch Warning: {e}")
-        return {}
+            log(f"⚠️ Hero Fetch Warning: {e}")
+        return cached # Stale names beat "Unknown"
 
     def fetch_matches():
-        print(f"⚔️ Fetching Dota 2 Matches for {STEAM_ID}...")
+        log(f"⚔️ Fetching Dota 2 Matches for {STEAM_ID}...")
         url = f"https://api.opendota.com/api/players/{STEAM_ID}/matches?limit=100&lobby_type=7" # Lobby 7 = Ranked
         try:
-            r = get_retry_session().get(url, timeout=20)
+            r = _SESSION.get(url, timeout=TIMEOUT)
             if r.status_code == 200:
-                return r.json()
-            print(f"❌ API Error: {r.text}")
+                return fastjson.loads(r.content)
+            log(f"❌ API Error: {r.text}")
         except Exception as e:
-            print(f"❌ Connection Error: {e}")
+            log(f"❌ Connection Error: {e}")
         return []
 
     # 3. EXECUTION
@@ -88,55 +133,57 @@ def run(full_config):
     if not matches: return
 
     # --- CALC STATS ---
+    # Single pass that counts games and wins per window instead of collecting
+    # three match lists and re-scanning each. Windows compare epoch seconds:
+    # "(now - match).days <= 7" is the same as "less than 8 whole days ago".
     now = datetime.datetime.now()
+    now_ts = now.timestamp()
+    cutoff_7 = now_ts - 8 * 86400
+    cutoff_30 = now_ts - 31 * 86400
+
     mmr_delta = 0
-    recent_20 = []
-    last_7_days = []
-    last_1_mo = []
+    games_20 = wins_20 = games_7 = wins_7 = games_30 = wins_30 = 0
+    last_is_win = False
     
-    for m in matches:
+    for i, m in enumerate(matches):
         is_radiant = m['player_slot'] < 128
-        radiant_win = m['radiant_win']
-        is_win = (is_radiant and radiant_win) or (not is_radiant and not radiant_win)
-        m['is_win'] = is_win 
-        
-        match_id = m['match_id']
-        match_dt = datetime.datetime.fromtimestamp(m['start_time'])
+        is_win = is_radiant == bool(m['radiant_win'])
+        if i == 0: last_is_win = is_win
         
         # MMR Calculation: Assume +/- 25 per ranked game since baseline
-        if match_id > START_MATCH_ID:
+        if m['match_id'] > START_MATCH_ID:
             mmr_delta += 25 if is_win else -25
             
-        recent_20.append(m) 
-        if (now - match_dt).days <= 7:
-            last_7_days.append(m)
-        if (now - match_dt).days <= 30:
-            last_1_mo.append(m)
-
-    recent_20 = recent_20[:20]
+        # Matches arrive newest first, so the first 20 are the recent 20
+        if i < 20:
+            games_20 += 1
+            wins_20 += is_win
+        start_time = m['start_time']
+        if start_time > cutoff_7:
+            games_7 += 1
+            wins_7 += is_win
+        if start_time > cutoff_30:
+            games_30 += 1
+            wins_30 += is_win
 
     current_mmr = START_MMR + mmr_delta
     mmr_needed = max(0, TARGET_MMR - current_mmr)
     wins_needed = int(mmr_needed / 25)
     wins_needed_str = f"+{wins_needed}"
     
-    def get_stat_str(match_list):
-        # Return None for the int value if list is empty
-        if not match_list: return "0-0", "0%", None 
-        wins = sum(1 for x in match_list if x['is_win'])
-        losses = len(match_list) - wins
-        if len(match_list) == 0: return "0-0", "0%", None
-        
-        win_pct = int((wins / len(match_list)) * 100)
-        return f"{wins}-{losses}", f"{win_pct}%", win_pct
+    def get_stat_str(wins, games):
+        # Return None for the int value if there were no games
+        if not games: return "0-0", "0%", None 
+        win_pct = int((wins / games) * 100)
+        return f"{wins}-{games - wins}", f"{win_pct}%", win_pct
 
-    w_20, p_20, pct_20 = get_stat_str(recent_20)
-    w_7,  p_7,  pct_7  = get_stat_str(last_7_days)
-    w_30, p_30, pct_30 = get_stat_str(last_1_mo)
+    w_20, p_20, pct_20 = get_stat_str(wins_20, games_20)
+    w_7,  p_7,  pct_7  = get_stat_str(wins_7, games_7)
+    w_30, p_30, pct_30 = get_stat_str(wins_30, games_30)
 
     last = matches[0]
     hero_name = heroes.get(last['hero_id'], "Unknown")
-    res = "WIN" if last['is_win'] else "LOSS"
+    res = "WIN" if last_is_win else "LOSS"
     kda = f"{last['kills']}-{last['deaths']}-{last['assists']}"
     last_match_str = f"{hero_name} ({kda}) - {res}"
 
@@ -171,50 +218,32 @@ def run(full_config):
     l_30, r_30 = get_split_widths(pct_30)
 
     # --- DATA MAPPING (LAYOUT DESIGNER) ---
-    pr_data = [""] * 250
-    pr_data[200] = "Immortal"     
-    pr_data[201] = str(current_mmr)
-    pr_data[202] = wins_needed_str
+    pr_data = [""] * PR_SIZE
+    pr_data[PR_RANK] = "Immortal"     
+    pr_data[PR_MMR] = str(current_mmr)
+    pr_data[PR_WINS_NEEDED] = wins_needed_str
     
     # Stats Text (Wins-Losses, Pct)
-    pr_data[203] = w_20
-    pr_data[204] = p_20
-    pr_data[205] = w_7
-    pr_data[206] = p_7
-    pr_data[207] = w_30
-    pr_data[208] = p_30
-    pr_data[209] = last_match_str
-    pr_data[210] = str(main_bar_w) # Main Bar Width
+    pr_data[PR_STATS_20[0]], pr_data[PR_STATS_20[1]] = w_20, p_20
+    pr_data[PR_STATS_7[0]],  pr_data[PR_STATS_7[1]]  = w_7, p_7
+    pr_data[PR_STATS_30[0]], pr_data[PR_STATS_30[1]] = w_30, p_30
+    pr_data[PR_LAST_MATCH] = last_match_str
+    pr_data[PR_MAIN_BAR] = str(main_bar_w) # Main Bar Width
     
     # SPLIT BAR WIDTHS
-    pr_data[220] = l_20 
-    pr_data[221] = r_20 
-    pr_data[222] = l_7  
-    pr_data[223] = r_7  
-    pr_data[224] = l_30 
-    pr_data[225] = r_30
+    pr_data[PR_SPLIT_20[0]], pr_data[PR_SPLIT_20[1]] = l_20, r_20
+    pr_data[PR_SPLIT_7[0]],  pr_data[PR_SPLIT_7[1]]  = l_7, r_7
+    pr_data[PR_SPLIT_30[0]], pr_data[PR_SPLIT_30[1]] = l_30, r_30
     
     # Timestamp
     if now.minute == 0:
         time_str = now.strftime("%b %-d, %-I %p")      
     else:
         time_str = now.strftime("%b %-d, %-I:%M %p")   
-    pr_data[226] = f"Last updated: {time_str}" 
-
-    unique_task_id = str(int(time.time()))
-    payload = {
-        "storeCode": STORE_CODE,
-        "taskId": unique_task_id,
-        "product": [{
-            "prCode": TAG_ID,
-            "layoutId": LAYOUT_ID,
-            "prInfo": pr_data,
-            "nfc": ""
-        }]
-    }
-    
+    pr_data[PR_UPDATED] = f"Last updated: {time_str}" 
+
     try:
-        get_retry_session().post(f"http://{GATEWAY_IP}/api/product", json=payload, timeout=20)
-        print(f"🚀 Dota Tag Updated! MMR: {pr_data[201]}")
+        gateway.push(TAG_ID, LAYOUT_ID, pr_data)
+        log(f"🚀 Dota Tag Updated! MMR: {pr_data[PR_MMR]}")
     except Exception as e:
-        print(f"❌ Gateway Error: {e}")
\ No newline at end of file
+        log(f"❌ Gateway Error: {e}")
\ No newline at end of file
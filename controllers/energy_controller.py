@@ -16,17 +16,67 @@ KEY FEATURES:
 
 import requests
 import datetime
-import time
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from controllers import _fastjson as fastjson
+from controllers._gateway import GatewayClient
+
 # --- VISUAL CONFIGURATION ---
 PIXELS_PER_KWH = 10     # Scaling factor: 2.5 kWh = 25 pixels high
 MAX_BAR_HEIGHT = 65     # Max height of the graph area in Layout Designer
 
-def run(full_config):
+# ---- PR map, matching 4p20c_Energy ----------------------------------------
+PR_SIZE = 101
+PR_YESTERDAY_KWH, PR_YESTERDAY_LABEL = 51, 52
+PR_MONTH_KWH, PR_MONTH_WATTS, PR_MONTH_COST = 53, 54, 55
+PR_YTD_KWH, PR_YTD_WATTS, PR_YTD_COST = 56, 57, 58
+PR_BARS = 60                                        # first of 30 bar heights
+PR_AXIS_LEFT, PR_AXIS_MID, PR_AXIS_RIGHT = 90, 91, 92
+PR_UPDATED = 93
+
+def bar_height(kwh):
+    """kWh to graph bar pixels, clamped to the graph area."""
+    pixel_h = min(int(kwh * PIXELS_PER_KWH), MAX_BAR_HEIGHT)
+    return 2 if pixel_h < 2 and kwh > 0 else pixel_h
+
+# --- NETWORK HELPER: RETRY SESSION ---
+# Kept for the life of the process; the Shelly Cloud handshake is paid once.
+def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=["HEAD", "GET", "OPTIONS"]
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+SHELLY_TIMEOUT = (5, 30)   # The statistics endpoint can take a while to answer
+
+# --- DATE LABELS ---
+# Shelly stamps are always "YYYY-MM-DD HH:MM:SS", so slice them instead of
+# going through strptime, and build each "Jan 21" label once per process.
+_DATE_LABELS = {}
+
+def date_label(stamp):
+    key = stamp[5:10]
+    label = _DATE_LABELS.get(key)
+    if label is None:
+        # 2000 is a leap year, so Feb 29 formats too
+        label = datetime.date(2000, int(stamp[5:7]), int(stamp[8:10])).strftime("%b %d")
+        _DATE_LABELS[key] = label
+    return label
+
+def run(full_config, log=print):
     # 1. LOAD CONFIG
-    sys = full_config['system']
     cfg = full_config['energy']
     
     # Default URL serves Shelly Cloud EU
@@ -34,29 +84,12 @@ def run(full_config):
     AUTH_KEY = cfg['auth_key']
     DEVICE_ID = cfg['device_id']
     
-    GATEWAY_IP = sys['gateway_ip']
-    STORE_CODE = sys['store_code']
+    gateway = GatewayClient.from_config(full_config)
     TAG_ID = cfg.get('tag_id', 'MY_STATS_02')
     LAYOUT_ID = "4p20c_Energy"
 
-    # --- NETWORK HELPER: RETRY SESSION ---
-    def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
     # 2. FETCH DATA FROM SHELLY CLOUD
-    print("🔌 Fetching Shelly Data...")
+    log("🔌 Fetching Shelly Data...")
     
     now = datetime.datetime.now()
     today_str = now.strftime("%Y-%m-%d")
@@ -73,20 +106,20 @@ def run(full_config):
     
     history = []
     try:
-        r = get_retry_session().get(SHELLY_BASE_URL, params=params, timeout=30)
+        r = _SESSION.get(SHELLY_BASE_URL, params=params, timeout=SHELLY_TIMEOUT)
         
         if r.status_code != 200:
-            print(f"❌ API Error: {r.text}")
+            log(f"❌ API Error: {r.text}")
             return
 
-        data = r.json()
+        data = fastjson.loads(r.content)
         raw_history = data.get('history', [])
         
         for entry in raw_history:
             # --- DATA FILTERING LOGIC ---
             # 1. Tariff ID '1': We only care about standard consumption (ignore returned/solar).
             # 2. Date < Today: We only show completed days.
-            entry_date_str = entry['datetime'].split(" ")[0]
+            entry_date_str = entry['datetime'][:10]
             if entry.get('tariff_id') == "1" and entry_date_str < today_str:
                 history.append({
                     'date': entry['datetime'],
@@ -94,99 +127,84 @@ def run(full_config):
                     'cost': entry.get('cost', 0)
                 })
     except Exception as e:
-        print(f"❌ Connection Error (Shelly): {e}")
+        log(f"❌ Connection Error (Shelly): {e}")
         return
 
     if not history: 
-        print("⚠️ No valid history found (check dates).")
+        log("⚠️ No valid history found (check dates).")
         return
 
     # 3. STAT CALCULATIONS
     yesterday = history[-1]
-    dt_obj = datetime.datetime.strptime(yesterday['date'], "%Y-%m-%d %H:%M:%S")
-    yesterday_str = dt_obj.strftime("%b %d")
-
-    # Last 30 Days Stats
-    last_30 = history[-30:]
-    month_kwh = sum(d['kwh'] for d in last_30)
-    month_cost = sum(d['cost'] for d in last_30)
-    month_days = len(last_30)
-    # Average Watts = (Total kWh / Days) -> Daily kWh -> *1000 / 24hrs -> Watts
-    month_avg_watts = int(((month_kwh / month_days) * 1000) / 24) if month_days else 0
+    yesterday_str = date_label(yesterday['date'])
 
-    # Year-To-Date Stats
+    # Last 30 Days and Year-To-Date Stats, totalled in one pass over history
     curr_year = str(now.year)
-    ytd = [d for d in history if d['date'].startswith(curr_year)]
-    ytd_kwh = sum(d['kwh'] for d in ytd)
-    ytd_cost = sum(d['cost'] for d in ytd)
-    ytd_days = len(ytd)
+    month_start = len(history) - 30
+    month_kwh = month_cost = month_days = 0
+    ytd_kwh = ytd_cost = ytd_days = 0
+    for i, d in enumerate(history):
+        kwh, cost = d['kwh'], d['cost']
+        if i >= month_start:
+            month_kwh += kwh
+            month_cost += cost
+            month_days += 1
+        if d['date'][:4] == curr_year:
+            ytd_kwh += kwh
+            ytd_cost += cost
+            ytd_days += 1
+
+    # Average Watts = (Total kWh / Days) -> Daily kWh -> *1000 / 24hrs -> Watts
+    month_avg_watts = int(((month_kwh / month_days) * 1000) / 24) if month_days else 0
     ytd_avg_watts = int(((ytd_kwh / ytd_days) * 1000) / 24) if ytd_days else 0
 
     # Date Markers for the X-Axis
     graph_slice = history[-29:] # The slice we actually draw
-    def fmt_date(entry):
-        d = datetime.datetime.strptime(entry['date'], "%Y-%m-%d %H:%M:%S")
-        return d.strftime("%b %d")
-
-    marker_right = fmt_date(graph_slice[-1]) if graph_slice else "-"
-    marker_mid   = fmt_date(graph_slice[len(graph_slice)//2]) if graph_slice else "-"
-    marker_left  = fmt_date(graph_slice[0]) if graph_slice else "-"
+    marker_right = date_label(graph_slice[-1]['date']) if graph_slice else "-"
+    marker_mid   = date_label(graph_slice[len(graph_slice)//2]['date']) if graph_slice else "-"
+    marker_left  = date_label(graph_slice[0]['date']) if graph_slice else "-"
 
     # 4. DATA MAPPING (LAYOUT DESIGNER)
-    pr_data = [""] * 101 
+    pr_data = [""] * PR_SIZE
     
     # [PR_51 - PR_52] : Header (Yesterday's Usage)
-    pr_data[51] = f"{yesterday['kwh']:.1f} kWh"
-    pr_data[52] = f"Power - {yesterday_str}"
+    pr_data[PR_YESTERDAY_KWH] = f"{yesterday['kwh']:.1f} kWh"
+    pr_data[PR_YESTERDAY_LABEL] = f"Power - {yesterday_str}"
     
     # [PR_53 - PR_55] : Month Stats
-    pr_data[53] = f"{int(month_kwh)} kWh"
-    pr_data[54] = f"{month_avg_watts} W"
-    pr_data[55] = f"${month_cost:.2f}"
+    pr_data[PR_MONTH_KWH] = f"{int(month_kwh)} kWh"
+    pr_data[PR_MONTH_WATTS] = f"{month_avg_watts} W"
+    pr_data[PR_MONTH_COST] = f"${month_cost:.2f}"
     
     # [PR_56 - PR_58] : YTD Stats
-    pr_data[56] = f"{int(ytd_kwh)} kWh"
-    pr_data[57] = f"{ytd_avg_watts} W"
-    pr_data[58] = f"${ytd_cost:.2f}"
+    pr_data[PR_YTD_KWH] = f"{int(ytd_kwh)} kWh"
+    pr_data[PR_YTD_WATTS] = f"{ytd_avg_watts} W"
+    pr_data[PR_YTD_COST] = f"${ytd_cost:.2f}"
     
     # [PR_90 - PR_92] : X-Axis Date Labels (Left, Center, Right)
-    pr_data[90] = marker_left
-    pr_data[91] = marker_mid
-    pr_data[92] = marker_right
+    pr_data[PR_AXIS_LEFT] = marker_left
+    pr_data[PR_AXIS_MID] = marker_mid
+    pr_data[PR_AXIS_RIGHT] = marker_right
 
     # [PR_93] : Timestamp
     if now.minute == 0:
         time_str = now.strftime("%b %-d, %-I %p")      
     else:
         time_str = now.strftime("%b %-d, %-I:%M %p")   
-    pr_data[93] = f"Last updated: {time_str}"
+    pr_data[PR_UPDATED] = f"Last updated: {time_str}"
 
     # [PR_60 - PR_89] : Graph Bars
     # Layout Designer: These fields control the HEIGHT of 30 distinct rectangles.
     # Logic: Convert kWh to pixels. Min height = 2px (so 0 usage is still visible as a dot).
-    for i, entry in enumerate(graph_slice):
-        pixel_h = int(entry['kwh'] * PIXELS_PER_KWH)
-        if pixel_h > MAX_BAR_HEIGHT: pixel_h = MAX_BAR_HEIGHT
-        if pixel_h < 2 and entry['kwh'] > 0: pixel_h = 2
-        pr_data[60 + i] = str(pixel_h)
+    bars = [str(bar_height(entry['kwh'])) for entry in graph_slice]
+    pr_data[PR_BARS:PR_BARS + len(bars)] = bars
 
     # 5. PUSH TO GATEWAY
-    payload = {
-        "storeCode": STORE_CODE,
-        "taskId": str(int(time.time())), 
-        "product": [{
-            "prCode": TAG_ID,
-            "layoutId": LAYOUT_ID,
-            "prInfo": pr_data,
-            "nfc": ""
-        }]
-    }
-    
     try:
-        r = get_retry_session().post(f"http://{GATEWAY_IP}/api/product", json=payload, timeout=20)
+        r = gateway.push(TAG_ID, LAYOUT_ID, pr_data)
         if r.status_code == 200:
-            print(f"🚀 Energy Tag Updated! (Latest Data: {marker_right})")
+            log(f"🚀 Energy Tag Updated! (Latest Data: {marker_right})")
         else:
-            print(f"❌ Gateway Error: {r.text}")
+            log(f"❌ Gateway Error: {r.text}")
     except Exception as e:
-        print(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
+        log(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
@@ -14,51 +14,53 @@ Triggers track map visibility using the circuitId string in PR_273.
 
 import requests
 import datetime
-import time
 from zoneinfo import ZoneInfo
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from controllers._gateway import GatewayClient
 
-def run(full_config):
+# --- NETWORK HELPER: RETRY SESSION ---
+# Built once at import and shared by every run. The four Jolpica calls in a run
+# then share one pooled TLS connection, and it stays warm for the next refresh.
+def get_retry_session(retries=3, backoff_factor=60):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504, 429),
+        allowed_methods=["HEAD", "GET", "OPTIONS"]
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+def run(full_config, log=print):
     # 1. LOAD CONFIGURATION
-    sys = full_config['system']
     cfg = full_config.get('f1', {}) 
     
-    GATEWAY_IP = sys['gateway_ip']
-    STORE_CODE = sys['store_code']
+    gateway = GatewayClient.from_config(full_config)
     TAG_ID = cfg['tag_id']
     LAYOUT_ID = "4p20c_Formula1"
 
-    # --- NETWORK HELPER: RETRY SESSION ---
-    def get_retry_session(retries=3, backoff_factor=60):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=(500, 502, 503, 504, 429),
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
     # 2. DATA FETCHING HELPER
     def fetch_jolpica_data(endpoint):
         # If endpoint is empty, it fetches the root current calendar
         url = f"https://api.jolpi.ca/ergast/f1/current/{endpoint}.json" if endpoint else "https://api.jolpi.ca/ergast/f1/current.json"
         try:
-            r = get_retry_session().get(url, timeout=20)
+            r = _SESSION.get(url, timeout=20)
             if r.status_code == 200:
                 return r.json()
-            print(f"❌ API Error: {r.text}")
+            log(f"❌ API Error: {r.text}")
         except Exception as e:
-            print(f"❌ Fetch Error ({endpoint}): {e}")
+            log(f"❌ Fetch Error ({endpoint}): {e}")
         return None
 
-    print("🏎️ Fetching F1 Data...")
+    log("🏎️ Fetching F1 Data...")
     
     # 3. EXECUTE API CALLS
     schedule_data = fetch_jolpica_data("")          # Full season schedule (to get total rounds)
@@ -67,7 +69,7 @@ def run(full_config):
     constructor_data = fetch_jolpica_data("constructorStandings")
 
     if not next_race_data:
-        print("❌ Could not fetch next race data.")
+        log("❌ Could not fetch next race data.")
         return
 
     # --- PROCESS RACE DATA ---
@@ -80,7 +82,7 @@ def run(full_config):
             total_rounds = schedule_data['MRData']['total']
             
     except (KeyError, IndexError):
-        print("⚠️ No upcoming races found in the calendar.")
+        log("⚠️ No upcoming races found in the calendar.")
         return
 
     season = race.get('season', '2026')
@@ -180,23 +182,11 @@ def run(full_config):
     pr_data[274] = f"Last updated: {time_str}"
 
     # 5. PUSH TO GATEWAY
-    unique_task_id = str(int(time.time()))
-    payload = {
-        "storeCode": STORE_CODE,
-        "taskId": unique_task_id,
-        "product": [{
-            "prCode": TAG_ID,
-            "layoutId": LAYOUT_ID,
-            "prInfo": pr_data,
-            "nfc": ""
-        }]
-    }
-    
     try:
-        r = get_retry_session().post(f"http://{GATEWAY_IP}/api/product", json=payload, timeout=20)
+        r = gateway.push(TAG_ID, LAYOUT_ID, pr_data)
         if r.status_code == 200:
-            print(f"✅ F1 Tag Updated! (Next Track: {track_id})")
+            log(f"✅ F1 Tag Updated! (Next Track: {track_id})")
         else:
-            print(f"❌ Gateway Error {r.status_code}: {r.text}")
+            log(f"❌ Gateway Error {r.status_code}: {r.text}")
     except Exception as e:
-        print(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
+        log(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
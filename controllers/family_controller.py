@@ -66,7 +66,7 @@ MAX_UPCOMING = len(UPCOMING_SLOTS)
 
 _token_cache = {}
 
-# Anything raised on the run path is captured into logs.json and rendered on the
+# Anything raised on the run path is captured into logs.jsonl and rendered on the
 # dashboard, which has no authentication. Calendar ids and service account
 # addresses are both email shaped, so scrub them out of any error text.
 _EMAILISH = re.compile(r"[\w.+-]+(?:@|%40)[\w.-]+\.[A-Za-z]{2,}")
@@ -85,12 +85,17 @@ def _session(retries=3, backoff_factor=2):
                   backoff_factor=backoff_factor,
                   status_forcelist=(429, 500, 502, 503, 504),
                   allowed_methods=["HEAD", "GET", "OPTIONS", "POST"])
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
 
+# One session for the life of the process: the token exchange, every calendar
+# page and the gateway push all reuse its pooled keep-alive connections.
+_SESSION = _session()
+
+
 def _load_key(path):
     if not os.path.isabs(path):
         root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -120,7 +125,7 @@ def _access_token(key):
         {"iss": email, "scope": SCOPE, "aud": TOKEN_URL, "iat": now, "exp": now + 3600},
         key["private_key"], algorithm="RS256",
     )
-    r = _session().post(
+    r = _SESSION.post(
         TOKEN_URL, timeout=20,
         data={"grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
               "assertion": assertion})
@@ -134,8 +139,8 @@ def _access_token(key):
 
 
 def _get(token, path, params=None, label=None):
-    r = _session().get(f"{CALENDAR_API}{path}", timeout=20, params=params or {},
-                       headers={"Authorization": f"Bearer {token}"})
+    r = _SESSION.get(f"{CALENDAR_API}{path}", timeout=20, params=params or {},
+                     headers={"Authorization": f"Bearer {token}"})
     if r.status_code != 200:
         # label, not path: the path carries the calendar id, url encoded so a
         # plain email match would not catch it.
@@ -344,7 +349,7 @@ def build_pr_data(todays, upcoming, now):
 # --------------------------------------------------------------------------
 # entry point
 # --------------------------------------------------------------------------
-def collect(cfg):
+def collect(cfg, log=print):
     """Fetch and split events. Returns (todays, upcoming, now)."""
     tz = ZoneInfo(cfg.get("timezone", "America/Los_Angeles"))
     now = datetime.datetime.now(tz)
@@ -380,20 +385,20 @@ def collect(cfg):
             seen.add(fingerprint)
             events.append(ev)
             kept += 1
-        # Deliberately not the calendar id: run output is teed into logs.json
+        # Deliberately not the calendar id: run output is logged into logs.jsonl
         # and rendered on the dashboard, which has no authentication.
-        print(f"   calendar {idx} of {len(calendar_ids)}: {kept} events")
+        log(f"   calendar {idx} of {len(calendar_ids)}: {kept} events")
 
     _, raw_upcoming = split_events(events, today)
     todays, upcoming = organise(events, today,
                                 collapse=cfg.get("collapse_recurring", True))
     folded = len(raw_upcoming) - len(upcoming)
     if folded:
-        print(f"   folded {folded} later occurrence(s) of recurring events")
+        log(f"   folded {folded} later occurrence(s) of recurring events")
     return todays, upcoming, now
 
 
-def run(full_config):
+def run(full_config, log=print):
     sys_cfg = full_config["system"]
     cfg = full_config.get("family", {})
 
@@ -401,13 +406,13 @@ def run(full_config):
     store_code = sys_cfg["store_code"]
     tag_id = cfg["tag_id"]
 
-    print("📅 Fetching Google Calendar events...")
-    todays, upcoming, now = collect(cfg)
+    log("📅 Fetching Google Calendar events...")
+    todays, upcoming, now = collect(cfg, log)
 
     state = layout_state(len(todays))
-    print(f"   today: {len(todays)} event(s) -> layout state {state}")
+    log(f"   today: {len(todays)} event(s) -> layout state {state}")
     if len(todays) > MAX_TODAY:
-        print(f"   ⚠️  {len(todays) - MAX_TODAY} of today's events will not fit and are dropped")
+        log(f"   ⚠️  {len(todays) - MAX_TODAY} of today's events will not fit and are dropped")
 
     pr_data = build_pr_data(todays, upcoming, now)
 
@@ -422,11 +427,11 @@ def run(full_config):
         }],
     }
 
-    r = _session().post(f"http://{gateway_ip}/api/product", json=payload, timeout=20)
+    r = _SESSION.post(f"http://{gateway_ip}/api/product", json=payload, timeout=20)
     if r.status_code == 200:
         # Counts only, never event titles: this line ends up on the dashboard.
-        print(f"✅ Family Calendar Tag Updated! "
-              f"({len(todays)} today, {len(upcoming)} upcoming)")
+        log(f"✅ Family Calendar Tag Updated! "
+            f"({len(todays)} today, {len(upcoming)} upcoming)")
     else:
         raise RuntimeError(f"Gateway Error {r.status_code}: {r.text[:300]}")
 
@@ -32,12 +32,23 @@ os.makedirs(DATA_DIR, exist_ok=True)
 LOCAL_JSON_PATH = os.path.join(DATA_DIR, "mercedes_data.json")
 STATE_FILE = os.path.join(DATA_DIR, "mercedes_state.json")
 
-def run(full_config):
+# --- HELPER: RETRY SESSION ---
+# Built once at import, so repeated runs in one process reuse the connection.
+def get_retry_session(retries=3, backoff_factor=1):
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+def run(full_config, log=print):
     # 1. LOAD CONFIG
     sys = full_config['system']
     
     if 'WebScraper' not in full_config:
-        print("⚠️ Config missing 'WebScraper' block. Skipping.")
+        log("⚠️ Config missing 'WebScraper' block. Skipping.")
         return
 
     cfg = full_config['WebScraper'] 
@@ -55,14 +66,6 @@ def run(full_config):
     SSH_KEY_PATH = cfg['ssh_key_path']
     REMOTE_PATH = cfg['remote_path']
 
-    # --- HELPER: RETRY SESSION ---
-    def get_retry_session(retries=3, backoff_factor=1):
-        session = requests.Session()
-        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        return session
-
     # --- HELPER: STATE MANAGEMENT ---
     def load_state():
         if os.path.exists(STATE_FILE):
@@ -72,10 +75,11 @@ def run(full_config):
         return {"seen_ids": [], "alert_expiry": None}
 
     def save_state(state):
-        with open(STATE_FILE, "w") as f: json.dump(state, f, indent=2)
+        payload = json.dumps(state, indent=2)
+        with open(STATE_FILE, "w") as f: f.write(payload)
 
     # 2. DOWNLOAD DATA (SCP)
-    print(f"🏎️  Fetching WebScraper Data from Azure...")
+    log(f"🏎️  Fetching WebScraper Data from Azure...")
     cmd = [
         "scp", "-i", SSH_KEY_PATH, "-o", "StrictHostKeyChecking=no",
         f"{AZURE_USER}@{AZURE_IP}:{REMOTE_PATH}", LOCAL_JSON_PATH
@@ -83,7 +87,7 @@ def run(full_config):
     try:
         subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError:
-        print("❌ SCP Download Failed. Check keys, IP, or file path.")
+        log("❌ SCP Download Failed. Check keys, IP, or file path.")
         return
 
     # 3. PROCESS DATA
@@ -91,7 +95,7 @@ def run(full_config):
         with open(LOCAL_JSON_PATH, "r") as f:
             new_data = json.load(f)
     except Exception as e:
-        print(f"❌ JSON Load Failed: {e}")
+        log(f"❌ JSON Load Failed: {e}")
         return
 
     state = load_state()
@@ -100,7 +104,7 @@ def run(full_config):
     new_finds = [uid for uid in current_ids if uid not in state['seen_ids']]
     
     if new_finds:
-        print(f"🚨 NEW CARS DETECTED: {new_finds}")
+        log(f"🚨 NEW CARS DETECTED: {new_finds}")
         state['alert_expiry'] = (datetime.datetime.now() + datetime.timedelta(hours=24)).isoformat()
         state['seen_ids'] = list(set(state['seen_ids']) | current_ids)
         save_state(state)
@@ -162,13 +166,13 @@ def run(full_config):
     }
     
     try:
-        response = get_retry_session().post(GATEWAY_URL, json=payload, timeout=20)
+        response = _SESSION.post(GATEWAY_URL, json=payload, timeout=20)
         if response.status_code == 200:
-            print(f"✅ WebScraper Tag Updated! ({'RED' if is_red else 'WHITE'} Alert)")
+            log(f"✅ WebScraper Tag Updated! ({'RED' if is_red else 'WHITE'} Alert)")
         else:
-            print(f"❌ Gateway Error {response.status_code}: {response.text}")
+            log(f"❌ Gateway Error {response.status_code}: {response.text}")
     except Exception as e:
-        print(f"❌ Connection Error: {e}")
+        log(f"❌ Connection Error: {e}")
 
 # ==========================================
 # STANDALONE TESTING BLOCK
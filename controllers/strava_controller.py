@@ -13,136 +13,176 @@ KEY FEATURES:
 - Auto-refreshes Strava OAuth tokens and saves them back to config.json.
 - Generates a 35-day calendar grid (Indices 100-134).
 - logic to "Bold" the current day's cell in the grid.
-- Robust Network Retry: Waits 60s between failures to survive WiFi dropouts.
+- Network Retry: Two quick retries, then leaves it to the next scheduled run.
 """
 
 import requests
-import json
 import datetime
-import time
 import calendar
+import functools
 import os
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from controllers import _fastjson as fastjson
+from controllers._gateway import GatewayClient
 
 # --- CONFIGURATION ---
 # These control the visual scaling of the progress bars.
 CONFIG_FILE = 'config.json'
 TARGET_WORKOUTS = 14     # Goal: 14 workouts/month = 100% bar width
 MAX_BAR_WIDTH = 147      # Pixel width of the progress bar on the layout
+XFIT_TYPES = frozenset(("WeightTraining", "CrossFit", "HIIT", "Workout"))
 
-def run(full_config):
+# Calendar cell states as bytes, see STATE MAPPING in run(). Today's cell is
+# the same state plus BOLD_SHIFT.
+CELL_BLANK, CELL_EMPTY, CELL_RUN, CELL_XFIT = b"0123"
+BOLD_SHIFT = 3
+
+@functools.lru_cache(maxsize=2)
+def month_grid(year, month):
+    """Weekday of the 1st, and the 35-cell grid with the month's days marked
+    empty. Only changes once a month, so it is worked out once a month."""
+    start_day_index, days_in_month = calendar.monthrange(year, month)
+    n = min(days_in_month, 35 - start_day_index)
+    grid = bytearray([CELL_BLANK]) * 35
+    grid[start_day_index:start_day_index + n] = bytes([CELL_EMPTY]) * n
+    return start_day_index, bytes(grid)
+
+# The layout binds slots 100-146 of 250. Each run starts from a copy of this.
+PR_SIZE = 250
+_PR_TEMPLATE = [""] * PR_SIZE
+
+# --- NETWORK HELPER: RETRY SESSION ---
+# Creates a request session that automatically retries failed connections.
+# Critical for Raspberry Pi setups where WiFi might sleep or be spotty.
+# Backoff is short (the first retry is immediate, the second waits 2s) and a
+# 429's Retry-After is honoured.
+# A run that still fails gives up and the next scheduled run tries again.
+# Built once at import and shared by the auth and activities calls, so the
+# pooled connection to Strava stays warm rather than paying a fresh TCP/TLS
+# handshake on every call. The bearer token goes on the one request that
+# needs it, never on the session.
+def get_retry_session(retries=2, backoff_factor=1, status_forcelist=(500, 502, 503, 504, 429)):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=["HEAD", "GET", "OPTIONS", "POST"],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+# --- STRAVA AUTHENTICATION ---
+# Strava tokens expire short-term. We use the Refresh Token to get a new Access Token.
+# If the Refresh Token itself rotates, we save the new one to 'config.json'.
+# Access tokens last about six hours, so the last one is kept in config.json
+# too and reused until a minute before it expires.
+def get_access_token(cfg, now_ts, log=print):
+    if cfg.get('access_token') and cfg.get('expires_at', 0) > now_ts + 60:
+        return cfg['access_token']
+
+    log("🔑 Refreshing Strava Access Token...")
+    refresh_token = cfg['refresh_token']
+    payload = {
+        'client_id': cfg['client_id'],
+        'client_secret': cfg['client_secret'],
+        'refresh_token': refresh_token,
+        'grant_type': 'refresh_token',
+        'f': 'json'
+    }
+    try:
+        r = _SESSION.post("https://www.strava.com/oauth/token", data=payload, timeout=20)
+        
+        if r.status_code == 200:
+            data = fastjson.loads(r.content)
+            
+            # SELF-HEALING CONFIG: Update file if token changes
+            new_refresh = data.get('refresh_token')
+            if new_refresh and new_refresh != refresh_token:
+                log("⚠️ Token Rotated! Updating config.json...")
+            else:
+                new_refresh = refresh_token
+            update_config_token(new_refresh, data['access_token'], data.get('expires_at', 0))
+            
+            return data['access_token']
+        log(f"❌ Auth Failed: {r.text}")
+    except Exception as e:
+        log(f"❌ Connection Error (Auth): {e}")
+    return None
+
+def update_config_token(new_token, access_token, expires_at):
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'rb') as f:
+            data = fastjson.loads(f.read())
+        data['fitness']['refresh_token'] = new_token
+        data['fitness']['access_token'] = access_token
+        data['fitness']['expires_at'] = expires_at
+        payload = fastjson.dumps(data, indent=True)
+        with open(CONFIG_FILE, 'wb') as f:
+            f.write(payload)
+
+# --- DATA FETCHING ---
+def fetch_activities(access_token, now, log=print):
+    log("🏃 Fetching Activities...")
+    # We only care about the current month's data
+    start_of_month = datetime.datetime(now.year, now.month, 1)
+    epoch_time = int(start_of_month.timestamp())
+    
+    headers = {'Authorization': f"Bearer {access_token}"}
+    params = {'after': epoch_time, 'per_page': 50}
+    
+    try:
+        r = _SESSION.get("https://www.strava.com/api/v3/athlete/activities", headers=headers, params=params, timeout=20)
+        if r.status_code == 200:
+            return fastjson.loads(r.content)
+        log(f"❌ API Error: {r.text}")
+    except Exception as e:
+        log(f"❌ Fetch Error: {e}")
+    return []
+
+def run(full_config, log=print, gateway=None):
     # 1. LOAD CONFIGURATION
-    # The 'system' block contains Hub-wide settings (Gateway IP, Store Code).
+    # The 'system' block (Gateway IP, Store Code) goes to the GatewayClient.
     # The 'fitness' block contains Strava specific credentials.
-    sys = full_config['system']
     cfg = full_config['fitness']
     
-    CLIENT_ID = cfg['client_id']
-    CLIENT_SECRET = cfg['client_secret']
-    REFRESH_TOKEN = cfg['refresh_token']
-    
-    GATEWAY_IP = sys['gateway_ip']
-    STORE_CODE = sys['store_code']
+    # A gateway passed in is batching: queue the tag on it rather than pushing
+    batched = gateway is not None
+    gateway = gateway or GatewayClient.from_config(full_config)
     TAG_ID = cfg['tag_id']
     LAYOUT_ID = "4p20c_Fitness"  # Must match the Layout ID in Rainus Web UI
 
-    # --- NETWORK HELPER: RETRY SESSION ---
-    # Creates a request session that automatically retries failed connections.
-    # Critical for Raspberry Pi setups where WiFi might sleep or be spotty.
-    # Backoff: 60s -> 120s -> 240s
-    def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
+    # One clock reading per run; every date, stamp and task ID comes from it.
+    # A batched run is the exception: its task ID is taken when run_batch flushes.
+    now = datetime.datetime.now()
+    now_ts = now.timestamp()
 
     # 2. STRAVA AUTHENTICATION
-    # Strava tokens expire short-term. We use the Refresh Token to get a new Access Token.
-    # If the Refresh Token itself rotates, we save the new one to 'config.json'.
-    def get_access_token():
-        print("🔑 Refreshing Strava Access Token...")
-        payload = {
-            'client_id': CLIENT_ID,
-            'client_secret': CLIENT_SECRET,
-            'refresh_token': REFRESH_TOKEN,
-            'grant_type': 'refresh_token',
-            'f': 'json'
-        }
-        try:
-            r = get_retry_session().post("https://www.strava.com/oauth/token", data=payload, timeout=20)
-            
-            if r.status_code == 200:
-                data = r.json()
-                
-                # SELF-HEALING CONFIG: Update file if token changes
-                new_refresh = data.get('refresh_token')
-                if new_refresh and new_refresh != REFRESH_TOKEN:
-                    print("⚠️ Token Rotated! Updating config.json...")
-                    update_config_token(new_refresh)
-                
-                return data['access_token']
-            print(f"❌ Auth Failed: {r.text}")
-        except Exception as e:
-            print(f"❌ Connection Error (Auth): {e}")
-        return None
-
-    def update_config_token(new_token):
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                data = json.load(f)
-            data['fitness']['refresh_token'] = new_token
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
-
-    # 3. DATA FETCHING
-    def fetch_activities(access_token):
-        print("🏃 Fetching Activities...")
-        # We only care about the current month's data
-        now = datetime.datetime.now()
-        start_of_month = datetime.datetime(now.year, now.month, 1)
-        epoch_time = int(start_of_month.timestamp())
-        
-        headers = {'Authorization': f"Bearer {access_token}"}
-        params = {'after': epoch_time, 'per_page': 50}
-        
-        try:
-            r = get_retry_session().get("https://www.strava.com/api/v3/athlete/activities", headers=headers, params=params, timeout=20)
-            if r.status_code == 200:
-                return r.json()
-            print(f"❌ API Error: {r.text}")
-        except Exception as e:
-            print(f"❌ Fetch Error: {e}")
-        return []
-
-    # 4. DATA PROCESSING
-    token = get_access_token()
+    token = get_access_token(cfg, now_ts, log)
     if not token: return
     
-    activities = fetch_activities(token)
+    # 3. DATA FETCHING
+    activities = fetch_activities(token, now, log)
     if isinstance(activities, dict): return 
 
-    now = datetime.datetime.now()
-    
+    # 4. DATA PROCESSING
     # --- CALENDAR GRID LOGIC ---
     # The layout expects a 35-cell grid (5 rows x 7 cols).
     # We map the days of the month to these cells based on the weekday the month starts.
-    grid = ["0"] * 35 
-    start_day_index, days_in_month = calendar.monthrange(now.year, now.month)
+    # Valid days start as '1' (Empty Box)
+    start_day_index, blank = month_grid(now.year, now.month)
+    grid = bytearray(blank)
     
-    # Mark valid days with '1' (Empty Box)
-    for day in range(1, days_in_month + 1):
-        grid_idx = start_day_index + (day - 1)
-        if grid_idx < 35: grid[grid_idx] = "1" 
+    # Day N sits at base + N
+    base = start_day_index - 1
 
     run_count = 0
     xfit_count = 0
@@ -152,37 +192,41 @@ def run(full_config):
     # Process each activity and update grid
     for act in activities:
         if not isinstance(act, dict): continue
-        if 'start_date_local' not in act or 'type' not in act: continue
+        get = act.get
+        if (s := get('start_date_local')) is None or (act_type := get('type')) is None: continue
 
+        # Strava sends "YYYY-MM-DDTHH:MM:SSZ", so the day is always [8:10]
+        if not isinstance(s, str) or len(s) < 10: continue
         try:
-            act_date = datetime.datetime.strptime(act['start_date_local'], "%Y-%m-%dT%H:%M:%SZ")
-            day_of_month = act_date.day
-            grid_idx = start_day_index + (day_of_month - 1)
-            
-            if grid_idx >= 35: continue 
-            
-            act_type = act['type']
-            
-            # STATE MAPPING (Layout Designer Conditions):
-            # '0' = Hidden/Blank
-            # '1' = Empty Box (Valid Date)
-            # '2' = Run Icon
-            # '3' = Weight/CrossFit Icon
-            
-            if act_type == "Run":
-                run_count += 1
-                if grid[grid_idx] != "3": grid[grid_idx] = "2" # Don't overwrite weights with run
-                if act.get('has_heartrate'):
-                    last_run['hr_avg'] = f"{int(act.get('average_heartrate',0))} bpm"
-                    last_run['hr_peak'] = f"{int(act.get('max_heartrate',0))} bpm"
-
-            elif act_type in ["WeightTraining", "CrossFit", "HIIT", "Workout"]:
-                xfit_count += 1
-                grid[grid_idx] = "3"
-                if act.get('has_heartrate'):
-                    last_xfit['hr_avg'] = f"{int(act.get('average_heartrate',0))} bpm"
-                    last_xfit['hr_peak'] = f"{int(act.get('max_heartrate',0))} bpm"
-        except: continue
+            day_of_month = int(s[8:10])
+        except ValueError: continue
+        grid_idx = base + day_of_month
+        
+        if grid_idx >= 35: continue 
+        
+        # STATE MAPPING (Layout Designer Conditions):
+        # '0' = Hidden/Blank
+        # '1' = Empty Box (Valid Date)
+        # '2' = Run Icon
+        # '3' = Weight/CrossFit Icon
+        
+        if act_type == "Run":
+            run_count += 1
+            if grid[grid_idx] != CELL_XFIT: grid[grid_idx] = CELL_RUN # Don't overwrite weights with run
+            hr_stats = last_run
+
+        elif act_type in XFIT_TYPES:
+            xfit_count += 1
+            grid[grid_idx] = CELL_XFIT
+            hr_stats = last_xfit
+
+        else: continue
+
+        if get('has_heartrate'):
+            try:
+                hr_stats['hr_avg'] = f"{int(get('average_heartrate', 0))} bpm"
+                hr_stats['hr_peak'] = f"{int(get('max_heartrate', 0))} bpm"
+            except (ValueError, TypeError): pass
 
     # --- TODAY HIGHLIGHT LOGIC ---
     # To show "Today" distinctly, we shift the state ID by +3.
@@ -190,12 +234,9 @@ def run(full_config):
     # 1 -> 4 (Bold Empty)
     # 2 -> 5 (Bold Run)
     # 3 -> 6 (Bold Weights)
-    today_idx = start_day_index + (now.day - 1)
-    if 0 <= today_idx < 35:
-        current_val = grid[today_idx]
-        bold_map = {"1": "4", "2": "5", "3": "6"}
-        if current_val in bold_map:
-            grid[today_idx] = bold_map[current_val]
+    today_idx = base + now.day
+    if 0 <= today_idx < 35 and CELL_EMPTY <= grid[today_idx] <= CELL_XFIT:
+        grid[today_idx] += BOLD_SHIFT
 
     # 5. DATA PACKING (ESL GATEWAY FORMAT)
     # pr_data list maps directly to 'Product Code' fields in Layout Designer.
@@ -203,10 +244,10 @@ def run(full_config):
     run_width = int((min(run_count, TARGET_WORKOUTS) / TARGET_WORKOUTS) * MAX_BAR_WIDTH)
     xfit_width = int((min(xfit_count, TARGET_WORKOUTS) / TARGET_WORKOUTS) * MAX_BAR_WIDTH)
 
-    pr_data = [""] * 250
+    pr_data = _PR_TEMPLATE[:]
     
     # [PR_100 - PR_134] : The 35 Calendar Grid Cells
-    for i, val in enumerate(grid): pr_data[100 + i] = val
+    pr_data[100:100 + len(grid)] = grid.decode()   # One "0"-"6" string per cell
         
     # [PR_139 - PR_140] : Progress Bar Widths (Layout Condition: Object Width)
     pr_data[139] = str(xfit_width)
@@ -227,23 +268,16 @@ def run(full_config):
     pr_data[145] = f"Last updated: {time_str}"
     pr_data[146] = now.strftime("%B")
 
-    unique_task_id = str(int(time.time()))
-    payload = {
-        "storeCode": STORE_CODE,
-        "taskId": unique_task_id,
-        "product": [{
-            "prCode": TAG_ID,
-            "layoutId": LAYOUT_ID,
-            "prInfo": pr_data,
-            "nfc": ""
-        }]
-    }
-    
+    if batched:
+        gateway.buffer(TAG_ID, LAYOUT_ID, pr_data)
+        log("📦 Strava Tag queued for the batch push")
+        return
+
     try:
-        r = get_retry_session().post(f"http://{GATEWAY_IP}/api/product", json=payload, timeout=20)
+        r = gateway.push(TAG_ID, LAYOUT_ID, pr_data, now_ts)
         if r.status_code == 200:
-            print("🚀 Strava Tag Updated!")
+            log("🚀 Strava Tag Updated!")
         else:
-            print(f"❌ Gateway Error: {r.text}")
+            log(f"❌ Gateway Error: {r.text}")
     except Exception as e:
-        print(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
+        log(f"❌ Connection Error (Gateway): {e}")
\ No newline at end of file
@@ -9,16 +9,17 @@ Fetches 2-day forecast for 3 cities (Seattle, Delhi, Hyderabad) via Open-Meteo.
 Displays current temps, highs/lows, and a 5-step hourly forecast for Seattle.
 
 KEY FEATURES:
-- Uses Open-Meteo (No API Key required).
+- Uses Open-Meteo (No API Key required). One request covers all three cities.
 - Maps Weather Codes (WMO) to string IDs (e.g., 'PARTLYCLOUDY') that match
   image filenames in the Rainus Layout Designer.
 """
 
 import requests
 import datetime
-import time
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from controllers import _fastjson as fastjson
+from controllers._gateway import GatewayClient
 
 # --- ASSET MAPPING ---
 # These strings (e.g., "RAIN") must match the Image Mapping keys in Layout Designer.
@@ -41,128 +42,177 @@ DESC_MAP = {
     95: "Thunderstorm", 96: "Thunderstorm/Hail", 99: "Heavy Hail"
 }
 
-def run(full_config):
+# --- NETWORK HELPER: RETRY SESSION ---
+# Two quick retries (the first immediate, the second after 2s), honouring a
+# 429's Retry-After. A run that still fails gives up and the next scheduled
+# run tries again.
+# One session per process, reused by every refresh.
+def get_retry_session(retries=2, backoff_factor=1, status_forcelist=(500, 502, 503, 504, 429)):
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=["HEAD", "GET", "OPTIONS"],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = get_retry_session()
+
+# Blank prInfo; a run copies it and fills slots 10-37.
+PR_SIZE = 100
+_PR_TEMPLATE = [""] * PR_SIZE
+
+# --- RESPONSE CACHE ---
+# coords -> (expires_at, data, etag, last_modified). A forecast is reused
+# for WX_CACHE_TTL seconds, and never past the top of the hour, since the
+# hourly tiles index the forecast by the current hour. After that the request
+# goes out conditional, and a 304 keeps the cached body for another TTL.
+WX_CACHE_TTL = 10 * 60
+_WX_CACHE = {}
+
+def _wx_expiry(ts):
+    next_hour = datetime.datetime.fromtimestamp(ts).replace(minute=0, second=0, microsecond=0)
+    return min(ts + WX_CACHE_TTL, next_hour.timestamp() + 3600)
+
+def fmt_hour(hour):
+    """Hourly tile label, "2 PM". Plain arithmetic rather than strftime's %-I,
+    which is glibc only."""
+    return f"{hour % 12 or 12} {'AM' if hour < 12 else 'PM'}"
+
+def fmt_updated(now):
+    """House format, matching the other controllers: "Aug 3, 2:43 AM",
+    dropping the minutes when it lands on the hour."""
+    hour = now.hour % 12 or 12
+    meridiem = "AM" if now.hour < 12 else "PM"
+    clock = f"{hour} {meridiem}" if now.minute == 0 else f"{hour}:{now.minute:02d} {meridiem}"
+    return f"Last updated: {now.strftime('%b')} {now.day}, {clock}"
+
+# --- FETCH WEATHER ---
+# Open-Meteo takes comma separated coordinates and answers with one forecast
+# per location, in order, so every city comes back in a single request over
+# one connection.
+def get_weather(coords, now_ts, log=print):
+    key = tuple(coords)
+    cached = _WX_CACHE.get(key)
+    if cached and now_ts < cached[0]: return cached[1]
+
+    lat = ",".join(str(c[0]) for c in coords)
+    lon = ",".join(str(c[1]) for c in coords)
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,weather_code&hourly=temperature_2m,weather_code,precipitation_probability&daily=temperature_2m_max,temperature_2m_min&temperature_unit=celsius&forecast_days=2&timeformat=unixtime&timezone=auto"
+    headers = {}
+    if cached and cached[2]: headers['If-None-Match'] = cached[2]
+    if cached and cached[3]: headers['If-Modified-Since'] = cached[3]
+    try:
+        r = _SESSION.get(url, headers=headers, timeout=70) 
+        if r.status_code == 304 and cached:
+            _WX_CACHE[key] = (_wx_expiry(now_ts),) + cached[1:]
+            return cached[1]
+        r.raise_for_status()
+        result = fastjson.loads(r.content)
+        if isinstance(result, dict): result = [result]   # A single location isn't wrapped
+        if len(result) != len(coords): raise ValueError(f"expected {len(coords)} forecasts, got {len(result)}")
+        _WX_CACHE[key] = (_wx_expiry(now_ts), result, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return result
+    except Exception as e:
+        log(f"⚠️ API Fetch Failed for {lat} / {lon}: {e}")
+        return None
+
+
+def run(full_config, log=print, gateway=None):
     # 1. LOAD CONFIG
-    sys = full_config['system']
     cfg = full_config['weather']
     
-    GATEWAY_URL = f"http://{sys['gateway_ip']}/api/product"
-    STORE_CODE = sys['store_code']
+    # A gateway passed in is batching: queue the tag on it rather than pushing
+    batched = gateway is not None
+    gateway = gateway or GatewayClient.from_config(full_config)
     TAG_ID = cfg['tag_id']
     LAYOUT_ID = "4p20c_Weather"
+
+    # One clock reading per run; every date, stamp and task ID comes from it.
+    # A batched run is the exception: its task ID is taken when run_batch flushes.
+    now = datetime.datetime.now()
+    now_ts = now.timestamp()
     
     LOCATIONS = cfg['locations']
 
-    # --- NETWORK HELPER: RETRY SESSION ---
-    def get_retry_session(retries=3, backoff_factor=60, status_forcelist=(500, 502, 503, 504, 429)):
-        session = requests.Session()
-        retry = Retry(
-            total=retries,
-            read=retries,
-            connect=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=status_forcelist,
-            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        return session
-
-    # 2. HELPER: FETCH WEATHER
-    def get_weather(lat, lon):
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,weather_code&hourly=temperature_2m,weather_code,precipitation_probability&daily=temperature_2m_max,temperature_2m_min&temperature_unit=celsius&forecast_days=2&timeformat=unixtime&timezone=auto"
-        try:
-            r = get_retry_session().get(url, timeout=70) 
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            print(f"⚠️ API Fetch Failed for {lat},{lon}: {e}")
-            return None
-
-    # 3. FETCH DATA
-    print(f"☁️ Fetching Weather for {list(LOCATIONS.keys())}...")
-    sea = get_weather(LOCATIONS["Seattle"]["lat"], LOCATIONS["Seattle"]["lon"])
-    delhi = get_weather(LOCATIONS["Delhi"]["lat"], LOCATIONS["Delhi"]["lon"])
-    hyd = get_weather(LOCATIONS["Hyderabad"]["lat"], LOCATIONS["Hyderabad"]["lon"])
+    # Bound once; every tile below goes through these
+    icon_get = ICON_MAP.get
+    desc_get = DESC_MAP.get
+    fromts = datetime.datetime.fromtimestamp
+
+    # 2. FETCH DATA
+    log(f"☁️ Fetching Weather for {list(LOCATIONS.keys())}...")
+    cities = ("Seattle", "Delhi", "Hyderabad")
+    forecasts = get_weather([(LOCATIONS[city]["lat"], LOCATIONS[city]["lon"]) for city in cities], now_ts, log)
     
-    if not sea or not delhi or not hyd:
-        print("❌ Weather Fetch Failed")
+    if not forecasts:
+        log("❌ Weather Fetch Failed")
         return
+    sea, delhi, hyd = forecasts
 
     # --- DATA MAPPING (LAYOUT DESIGNER) ---
-    data = [""] * 100 
+    data = _PR_TEMPLATE[:]
 
     # [PR_10 - PR_14] : Seattle Summary
     curr = sea['current']
     daily = sea['daily']
     data[10] = f"{int(curr['temperature_2m'])}°"
-    data[11] = DESC_MAP.get(curr['weather_code'], "")
+    data[11] = desc_get(curr['weather_code'], "")
     data[12] = f"{int(daily['temperature_2m_min'][0])}° , {int(daily['temperature_2m_max'][0])}°"
     
     # Smart Timestamp
-    now = datetime.datetime.now()
-    if now.minute == 0:
-        time_str = now.strftime("%b %-d, %-I %p")      
-    else:
-        time_str = now.strftime("%b %-d, %-I:%M %p")   
-    data[13] = f"Last updated: {time_str}"
-    data[14] = ICON_MAP.get(curr['weather_code'], "PARTLYCLOUDY")
+    data[13] = fmt_updated(now)
+    data[14] = icon_get(curr['weather_code'], "PARTLYCLOUDY")
 
     # [PR_15 - PR_29] : Hourly Forecast (Next 15 hours in 3-hour steps)
     hourly = sea['hourly']
-    current_hour_idx = datetime.datetime.now().hour
-    for i in range(5):
-        # We skip ahead 3 hours per step (i.e., +3, +6, +9...)
-        target_idx = current_hour_idx + ((i + 1) * 3)
-        if target_idx >= len(hourly['time']): break
-        
-        ts = hourly['time'][target_idx]
-        dt = datetime.datetime.fromtimestamp(ts)
-        
-        data[15 + i] = dt.strftime("%-I %p") # Time (e.g. "2 PM")
-        
-        code = hourly['weather_code'][target_idx]
-        data[20 + i] = ICON_MAP.get(code, "PARTLYCLOUDY") # Icon
-        
-        temp = int(hourly['temperature_2m'][target_idx])
-        rain = hourly['precipitation_probability'][target_idx]
-        data[25 + i] = f"{temp}° R: {rain}" # Temp & Rain Prob
+    times = hourly['time']
+    codes = hourly['weather_code']
+    temps = hourly['temperature_2m']
+    rains = hourly['precipitation_probability']
+
+    # We skip ahead 3 hours per step (i.e., +3, +6, +9...)
+    current_hour_idx = now.hour
+    targets = [t for t in range(current_hour_idx + 3, current_hour_idx + 16, 3) if t < len(times)]
+    for i, t in enumerate(targets):
+        data[15 + i] = fmt_hour(fromts(times[t]).hour) # Time (e.g. "2 PM")
+        data[20 + i] = icon_get(codes[t], "PARTLYCLOUDY") # Icon
+        data[25 + i] = f"{int(temps[t])}° R: {rains[t]}" # Temp & Rain Prob
 
     # [PR_30 - PR_33] : Delhi Summary
     d_curr = delhi['current']
     d_daily = delhi['daily']
     data[30] = "Delhi, DL"
-    data[31] = f"{int(d_curr['temperature_2m'])}° {DESC_MAP.get(d_curr['weather_code'], '')}"
+    data[31] = f"{int(d_curr['temperature_2m'])}° {desc_get(d_curr['weather_code'], '')}"
     data[32] = f"{int(d_daily['temperature_2m_max'][0])}° , {int(d_daily['temperature_2m_min'][0])}°"
-    data[33] = ICON_MAP.get(d_curr['weather_code'], "PARTLYCLOUDY")
+    data[33] = icon_get(d_curr['weather_code'], "PARTLYCLOUDY")
 
     # [PR_34 - PR_37] : Hyderabad Summary
     h_curr = hyd['current']
     h_daily = hyd['daily']
     data[34] = "Hyderabad, TS"
-    data[35] = f"{int(h_curr['temperature_2m'])}° {DESC_MAP.get(h_curr['weather_code'], '')}"
+    data[35] = f"{int(h_curr['temperature_2m'])}° {desc_get(h_curr['weather_code'], '')}"
     data[36] = f"{int(h_daily['temperature_2m_max'][0])}° , {int(h_daily['temperature_2m_min'][0])}°"
-    data[37] = ICON_MAP.get(h_curr['weather_code'], "PARTLYCLOUDY")
-
-    # 4. PUSH TO GATEWAY
-    task_id = str(int(time.time() * 1000))
-    payload = {
-        "storeCode": STORE_CODE,
-        "taskId": task_id,
-        "product": [{
-            "prCode": TAG_ID,
-            "layoutId": LAYOUT_ID,
-            "prInfo": data, 
-            "nfc": ""
-        }]
-    }
-    
+    data[37] = icon_get(h_curr['weather_code'], "PARTLYCLOUDY")
+
+    # 3. PUSH TO GATEWAY
+    if batched:
+        gateway.buffer(TAG_ID, LAYOUT_ID, data)
+        log("📦 Weather Tag queued for the batch push")
+        return
+
     try:
-        response = get_retry_session().post(GATEWAY_URL, json=payload, timeout=20)
+        response = gateway.push(TAG_ID, LAYOUT_ID, data, now_ts)
         if response.status_code == 200:
-            print(f"✅ Weather Tag Updated! (Seattle: {data[10]})")
+            log(f"✅ Weather Tag Updated! (Seattle: {data[10]})")
         else:
-            print(f"❌ Gateway Error {response.status_code}: {response.text}")
+            log(f"❌ Gateway Error {response.status_code}: {response.text}")
     except Exception as e:
-        print(f"❌ Connection Error: {e}")
\ No newline at end of file
+        log(f"❌ Connection Error: {e}")
\ No newline at end of file